@@ -1,21 +1,34 @@
 import argparse
 import asyncio
 import logging
-from asyncio import Queue, create_task
+from asyncio import Queue, QueueShutDown
+from bisect import bisect_left
 from datetime import datetime
 from pathlib import Path
 from typing import List
 
 import aiohttp
+import uvloop
+from client import (
+    json_payload,
+    make_notion_session,
+    make_session,
+    read_error,
+    read_json,
+)
+from log_config import setup_logging
+from notion import (
+    NOTION_PAGES_URL,
+    NOTION_PARENT,
+    NOTION_STATIC_PROPS,
+    check_rate_limit,
+    notion_writer,
+)
 from settings import settings
 
 current_file = Path(__file__)
-logging.basicConfig(
-    level=logging.INFO,
-    format="%(asctime)s - %(levelname)-5s - %(message)s",
-    filename=Path(
-        current_file.parent, "logs", current_file.name.replace(".py", ".log")
-    ),
+setup_logging(
+    Path(current_file.parent, "logs", current_file.name.replace(".py", ".log"))
 )
 logger = logging.getLogger(__name__)
 
@@ -49,85 +62,129 @@ def parse_args() -> int:
     return args.workers, args.test, args.date
 
 
-async def fill_queue(session: aiohttp.ClientSession, queue: Queue) -> None:
-    response = await session.get(
+async def fill_queue(
+    session: aiohttp.ClientSession, queue: Queue, stop_event: asyncio.Event
+) -> None:
+    async with session.get(
         url=settings.negotiation_url,
-        headers=settings.hh_headers,
         params={"order_by": "created_at", "order": "desc"},
-    )
-    if response.status != 200:
-        logger.error(
-            f"Error fetching {settings.vacancies_url}: {response.status}\n{await response.text()}"
-        )
-    else:
-        response_json = await response.json()
-        pages, per_page = response_json["pages"], response_json["per_page"]
-        logger.info(
-            f"Got {response_json['found']} negotiations, {pages} pages, {per_page} per page"
-        )
-        for i in range(pages):
-            logger.info(f"Add block ({i},{per_page}) to queue")
-            await queue.put((i, per_page))
+    ) as response:
+        if response.status != 200:
+            logger.error(
+                "Error fetching %s: %s\n%s",
+                settings.negotiation_url,
+                response.status,
+                await read_error(response),
+            )
+        else:
+            response_json = await read_json(response)
+            pages, per_page = response_json["pages"], response_json["per_page"]
+            logger.info(
+                "Got %s negotiations, %s pages, %s per page",
+                response_json["found"],
+                pages,
+                per_page,
+            )
+            for i in range(pages):
+                if stop_event.is_set():
+                    logger.info(
+                        "Reached applies older than the date, stop at block %s", i
+                    )
+                    break
+                logger.info("Add block (%s,%s) to queue", i, per_page)
+                # The first block is already here, hand it over instead of refetching
+                await queue.put(
+                    (i, per_page, response_json["items"] if i == 0 else None)
+                )
 
 
 async def fetch_negotiation_page(
     session: aiohttp.ClientSession,
     queue: Queue,
+    notion_queue: Queue,
+    stop_event: asyncio.Event,
     applies_after_date: datetime,
     test_run: bool,
 ) -> None:
     while True:
-        page, per_page = await queue.get()
-        logger.info(f"Fetch block ({page},{per_page}) from queue")
         try:
-            negotiations = await fetch_negotiations_from_page(
-                session=session, page=page, per_page=per_page
+            page, per_page, negotiations = await queue.get()
+        except QueueShutDown:
+            return
+        try:
+            if stop_event.is_set():
+                logger.info("Skip block (%s,%s) from queue", page, per_page)
+                continue
+            if negotiations is None:
+                logger.info("Fetch block (%s,%s) from queue", page, per_page)
+                negotiations = await fetch_negotiations_from_page(
+                    session=session, page=page, per_page=per_page
+                )
+            # Negotiations are sorted by created_at desc, so the new ones are a prefix
+            new_count = bisect_left(
+                negotiations,
+                True,
+                key=lambda negotiation: datetime.fromisoformat(
+                    negotiation["created_at"]
+                )
+                < applies_after_date,
             )
-            for idx, negotiation in enumerate(negotiations):
-                if (
-                    datetime.strptime(negotiation["created_at"], "%Y-%m-%dT%H:%M:%S%z")
-                    < applies_after_date
-                ):
-                    continue
+            if new_count < len(negotiations):
+                stop_event.set()
+            for idx, negotiation in enumerate(negotiations[:new_count]):
                 logger.info(
-                    f"Page={page:02d} idx={idx:02d}: "
-                    f"{negotiation['created_at']} {negotiation['id']} "
-                    f"{negotiation['vacancy']['name']}"
-                    f"{negotiation['vacancy']['employer']['name']} "
+                    "Page=%02d idx=%02d: %s %s %s %s",
+                    page,
+                    idx,
+                    negotiation["created_at"],
+                    negotiation["id"],
+                    negotiation["vacancy"]["name"],
+                    negotiation["vacancy"]["employer"]["name"],
                 )
                 if not test_run:
-                    await add_apply_to_notion(
-                        session=session,
-                        company=negotiation["vacancy"]["employer"]["name"],
-                        position=negotiation["vacancy"]["name"],
-                        url=negotiation["vacancy"]["alternate_url"],
-                        negotiation_url=f"/negotiations/{negotiation['id']}",
+                    notion_queue.put_nowait(
+                        {
+                            "company": negotiation["vacancy"]["employer"]["name"],
+                            "position": negotiation["vacancy"]["name"],
+                            "url": negotiation["vacancy"]["alternate_url"],
+                            "negotiation_url": f"/negotiations/{negotiation['id']}",
+                        }
                     )
         except Exception as e:
             logger.error(
-                f"Fetch block ({page},{per_page}) from queue finished with error {str(e)}"
+                "Fetch block (%s,%s) from queue finished with error %s",
+                page,
+                per_page,
+                e,
             )
-        finally:
-            queue.task_done()
 
 
 async def fetch_negotiations_from_page(
     session: aiohttp.ClientSession, page: int, per_page: int
 ) -> List:
-    response = await session.get(
+    async with session.get(
         url=settings.negotiation_url,
-        params={"page": page, "per_page": per_page},
-        headers=settings.hh_headers,
-    )
-    if response.status != 200:
-        logger.error(
-            f"Error fetching {settings.vacancies_url} with page={page} per_page={per_page}: {response.status}\n{await response.text()}"
-        )
-        return []
-    else:
-        response_json = await response.json()
-        logger.info(f"Page={page} got {len(response_json['items'])} vacancies")
-        return response_json["items"]
+        params={
+            "order_by": "created_at",
+            "order": "desc",
+            "page": page,
+            "per_page": per_page,
+        },
+    ) as response:
+        if response.status != 200:
+            logger.error(
+                "Error fetching %s with page=%s per_page=%s: %s\n%s",
+                settings.negotiation_url,
+                page,
+                per_page,
+                response.status,
+                await read_error(response),
+            )
+            return []
+        else:
+            response_json = await read_json(response)
+            logger.info("Page=%s got %s vacancies", page, len(response_json["items"]))
+            return response_json["items"]
 
 
 async def add_apply_to_notion(
@@ -141,59 +198,71 @@ async def add_apply_to_notion(
         return
 
     new_page_props = {
+        **NOTION_STATIC_PROPS,
         "COMPANY": {"title": [{"text": {"content": company}}]},
         "POSITION": {"rich_text": [{"type": "text", "text": {"content": position}}]},
-        "APPLICATION DATE": {"date": {"start": settings.notion_apply_date}},
         "JOB POST": {"url": url},
-        "STATUS": {"status": {"name": "Applied"}},
         "HH negotiation url": {"url": negotiation_url},
-        "RESUME USED": {"relation": [{"id": settings.notion_resume_id}]},
     }
-    response = await session.post(
-        url=f"{settings.notion_api_url}/pages",
-        headers=settings.notion_headers,
-        json={
-            "parent": {"database_id": settings.notion_db_id},
-            "properties": new_page_props,
-        },
+    async with session.post(
+        url=NOTION_PAGES_URL,
+        data=json_payload({"parent": NOTION_PARENT, "properties": new_page_props}),
         proxy=settings.notion_proxy,
-    )
-    if response.status != 200:
-        logger.error(
-            f"NOTION: Could not create a page for {url}: {response.status} {await response.text()}"
-        )
-    else:
-        response_json = await response.json()
-        logger.info(f"NOTION: Page created with id: {response_json['id']}")
+    ) as response:
+        check_rate_limit(response)
+        if response.status != 200:
+            logger.error(
+                "NOTION: Could not create a page for %s: %s %s",
+                url,
+                response.status,
+                await read_error(response),
+            )
+        else:
+            response_json = await read_json(response)
+            logger.info("NOTION: Page created with id: %s", response_json["id"])
 
 
 async def main(workers_num: int, applies_after_date: datetime, test_run: bool) -> None:
     if not settings.notion_enabled:
         logger.info("NOTION: Notion is disabled")
 
-    queue = Queue()
-    async with aiohttp.ClientSession() as session:
-        await fill_queue(session, queue)
-        workers = [
-            create_task(
-                fetch_negotiation_page(
-                    session=session,
-                    queue=queue,
-                    applies_after_date=applies_after_date,
-                    test_run=test_run,
+    queue = Queue(maxsize=workers_num)
+    notion_queue = Queue()
+    stop_event = asyncio.Event()
+    async with (
+        make_session(workers_num) as session,
+        make_notion_session(workers_num) as notion_session,
+    ):
+        async with asyncio.TaskGroup() as writer_tg:
+            writer_tg.create_task(
+                notion_writer(
+                    session=notion_session,
+                    notion_queue=notion_queue,
+                    add_page=add_apply_to_notion,
+                    label_key="url",
                 )
             )
-            for _ in range(workers_num)
-        ]
-        await queue.join()
-        for task in workers:
-            task.cancel()
-        await asyncio.gather(*workers, return_exceptions=True)
+            async with asyncio.TaskGroup() as tg:
+                for _ in range(workers_num):
+                    tg.create_task(
+                        fetch_negotiation_page(
+                            session=session,
+                            queue=queue,
+                            notion_queue=notion_queue,
+                            stop_event=stop_event,
+                            applies_after_date=applies_after_date,
+                            test_run=test_run,
+                        )
+                    )
+                await fill_queue(session=session, queue=queue, stop_event=stop_event)
+                # Workers exit once the remaining blocks are consumed
+                queue.shutdown()
+            notion_queue.shutdown()
 
 
 if __name__ == "__main__":
     workers_num, test_run, applies_after_date = parse_args()
-    asyncio.run(
+    uvloop.run(
         main(
             workers_num=workers_num,
             applies_after_date=applies_after_date,
@@ -0,0 +1,103 @@
+import asyncio
+import logging
+from typing import Any
+
+import aiohttp
+import orjson
+from multidict import CIMultiDictProxy
+from settings import settings
+
+logger = logging.getLogger(__name__)
+
+SESSION_TIMEOUT = aiohttp.ClientTimeout(total=30)
+ERROR_BODY_LIMIT = 512
+
+
+class AdaptiveLimiter:
+    """Concurrency limit that doubles while requests get answered and halves on 429"""
+
+    def __init__(self, max_limit: int) -> None:
+        self.limit = 1
+        self.max_limit = max_limit
+        self._in_flight = 0
+        self._successes = 0
+        # Bumped on every limit change, so responses to requests dispatched
+        # under an older limit don't move the new one
+        self._generation = 0
+        self._condition = asyncio.Condition()
+
+    async def __aenter__(self) -> int:
+        async with self._condition:
+            await self._condition.wait_for(lambda: self._in_flight < self.limit)
+            self._in_flight += 1
+            return self._generation
+
+    async def __aexit__(self, *exc_info) -> None:
+        async with self._condition:
+            self._in_flight -= 1
+            self._condition.notify_all()
+
+    def succeeded(self, generation: int) -> None:
+        if generation != self._generation or self.limit >= self.max_limit:
+            return
+        self._successes += 1
+        if self._successes >= self.limit:
+            self._set_limit(min(self.limit * 2, self.max_limit))
+            logger.info("Concurrency increased to %s", self.limit)
+
+    def throttled(self, generation: int) -> None:
+        if generation != self._generation:
+            return
+        self._set_limit(max(self.limit // 2, 1))
+        logger.info("Rate limited, concurrency set to %s", self.limit)
+
+    def _set_limit(self, limit: int) -> None:
+        self.limit = limit
+        self._successes = 0
+        self._generation += 1
+
+
+def _json_dumps(obj: object) -> str:
+    return orjson.dumps(obj).decode()
+
+
+async def read_json(response: aiohttp.ClientResponse) -> Any:
+    # orjson parses the raw bytes, response.json() would decode them to str first
+    return orjson.loads(await response.read())
+
+
+async def read_error(response: aiohttp.ClientResponse) -> str:
+    # Error bodies can be whole HTML pages, the head is enough for the logs
+    return (await response.read())[:ERROR_BODY_LIMIT].decode(errors="replace")
+
+
+def json_payload(obj: object) -> aiohttp.BytesPayload:
+    # Skips the bytes -> str -> bytes round trip of json=
+    return aiohttp.BytesPayload(orjson.dumps(obj), content_type="application/json")
+
+
+def _make_session(
+    workers_num: int,
+    headers: CIMultiDictProxy,
+) -> aiohttp.ClientSession:
+    connector = aiohttp.TCPConnector(
+        limit=workers_num * 4,
+        limit_per_host=workers_num * 2,
+        keepalive_timeout=75,
+        ttl_dns_cache=300,
+    )
+    return aiohttp.ClientSession(
+        connector=connector,
+        headers=headers,
+        timeout=SESSION_TIMEOUT,
+        json_serialize=_json_dumps,
+    )
+
+
+def make_session(workers_num: int) -> aiohttp.ClientSession:
+    return _make_session(workers_num=workers_num, headers=settings.hh_headers)
+
+
+def make_notion_session(workers_num: int) -> aiohttp.ClientSession:
+    # Separate pool so proxied Notion connections don't evict HH keep-alives
+    return _make_session(workers_num=workers_num, headers=settings.notion_headers)
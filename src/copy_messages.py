@@ -1,11 +1,16 @@
 import argparse
-from typing import Dict
+from typing import Dict, List
 
-import requests
+import aiohttp
+import uvloop
 from tqdm import tqdm
 
+from client import make_notion_session, make_session, read_error, read_json
 from settings import settings
 
+# Notion accepts up to 100 children per append, every message takes two blocks
+MESSAGES_PER_REQUEST = 50
+
 
 def parse_args() -> int:
     parser = argparse.ArgumentParser(
@@ -21,21 +26,38 @@ def parse_args() -> int:
     return args.id
 
 
-def add_messages(negotiation_id: str) -> None:
-    with tqdm(total=1, desc="Getting notion page id") as pbar:
-        notion_page_id = get_notion_page(negotiation_id=negotiation_id)
-        pbar.update(1)
-    if not notion_page_id:
-        print("Can't get notion page id")
-        return
-    with tqdm(total=1, desc="Getting messages from HH") as pbar:
-        messages = get_messages(negotiation_id=negotiation_id)
-        pbar.update(1)
-    for message in tqdm(messages, desc="Adding messages to notion"):
-        add_message_to_notion(page_id=notion_page_id, message=message)
-
-
-def get_notion_page(negotiation_id: str) -> str:
+async def add_messages(negotiation_id: str) -> None:
+    async with (
+        make_session(1) as session,
+        make_notion_session(1) as notion_session,
+    ):
+        with tqdm(total=1, desc="Getting notion page id") as pbar:
+            notion_page_id = await get_notion_page(
+                session=notion_session, negotiation_id=negotiation_id
+            )
+            pbar.update(1)
+        if not notion_page_id:
+            print("Can't get notion page id")
+            return
+        with tqdm(total=1, desc="Getting messages from HH") as pbar:
+            messages = await get_messages(
+                session=session, negotiation_id=negotiation_id
+            )
+            pbar.update(1)
+        # Appends are sequential so the messages keep their order on the page
+        with tqdm(total=len(messages), desc="Adding messages to notion") as pbar:
+            for i in range(0, len(messages), MESSAGES_PER_REQUEST):
+                batch = messages[i : i + MESSAGES_PER_REQUEST]
+                await add_messages_to_notion(
+                    session=notion_session,
+                    page_id=notion_page_id,
+                    messages=batch,
+                    first=i,
+                )
+                pbar.update(len(batch))
+
+
+async def get_notion_page(session: aiohttp.ClientSession, negotiation_id: str) -> str:
     db_filter = {
         "filter": {
             "and": [
@@ -47,65 +69,72 @@ def get_notion_page(negotiation_id: str) -> str:
         }
     }
 
-    response = requests.post(
+    async with session.post(
         url=f"{settings.notion_api_url}/databases/{settings.notion_db_id}/query",
-        headers=settings.notion_headers,
         json=db_filter,
-        proxies={"http": settings.notion_proxy, "https": settings.notion_proxy},
-    )
-    if response.status_code == 200:
-        return response.json()["results"][0]["id"]
-    return ""
+        proxy=settings.notion_proxy,
+    ) as response:
+        if response.status == 200:
+            return (await read_json(response))["results"][0]["id"]
+        return ""
 
 
-def get_messages(negotiation_id: str):
-    response = requests.get(
+async def get_messages(session: aiohttp.ClientSession, negotiation_id: str):
+    async with session.get(
         url=f"{settings.negotiation_url}/{negotiation_id}/messages",
-        headers=settings.hh_headers,
-    )
-    if response.status_code == 200:
-        return response.json()["items"][1:]
-    return []
+    ) as response:
+        if response.status == 200:
+            return (await read_json(response))["items"][1:]
+        return []
+
+
+def message_blocks(message: Dict) -> List[Dict]:
+    return [
+        {
+            "object": "block",
+            "type": "paragraph",
+            "paragraph": {
+                "rich_text": [
+                    {
+                        "type": "text",
+                        "text": {
+                            "content": message["text"],
+                        },
+                    }
+                ],
+                "color": "default"
+                if message["author"]["participant_type"] == "applicant"
+                else "gray_background",
+            },
+        },
+        {
+            "object": "block",
+            "type": "divider",
+            "divider": {},
+        },
+    ]
 
 
-def add_message_to_notion(page_id: str, message: Dict):
-    response = requests.patch(
+async def add_messages_to_notion(
+    session: aiohttp.ClientSession, page_id: str, messages: List[Dict], first: int
+):
+    async with session.patch(
         url=f"{settings.notion_api_url}/blocks/{page_id}/children",
-        headers=settings.notion_headers,
-        proxies={"http": settings.notion_proxy, "https": settings.notion_proxy},
         json={
             "children": [
-                {
-                    "object": "block",
-                    "type": "paragraph",
-                    "paragraph": {
-                        "rich_text": [
-                            {
-                                "type": "text",
-                                "text": {
-                                    "content": message["text"],
-                                },
-                            }
-                        ],
-                        "color": "default"
-                        if message["author"]["participant_type"] == "applicant"
-                        else "gray_background",
-                    },
-                },
-                {
-                    "object": "block",
-                    "type": "divider",
-                    "divider": {},
-                },
+                block for message in messages for block in message_blocks(message)
             ]
         },
-    )
-
-    if response.status_code != 200:
-        print(f"Can't add message {message} to notion {response.text}")
+        proxy=settings.notion_proxy,
+    ) as response:
+        if response.status != 200:
+            print(
+                f"Can't add messages {first}-{first + len(messages) - 1} "
+                f"to notion page {page_id}: {await read_error(response)}"
+            )
 
 
 if __name__ == "__main__":
     negotiation_id = parse_args()
     if negotiation_id:
-        add_messages(negotiation_id)
+        uvloop.run(add_messages(negotiation_id))
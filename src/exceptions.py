@@ -1,2 +1,12 @@
 class HH_Limit_Exceeded_Error(Exception):
     pass
+
+
+class HH_Rate_Limited_Error(Exception):
+    pass
+
+
+class Notion_Rate_Limited_Error(Exception):
+    def __init__(self, retry_after: float) -> None:
+        super().__init__(f"rate limited, retry after {retry_after}s")
+        self.retry_after = retry_after
@@ -0,0 +1,23 @@
+import atexit
+import logging
+from logging.handlers import QueueHandler, QueueListener
+from pathlib import Path
+from queue import SimpleQueue
+
+LOG_FORMAT = "%(asctime)s - %(levelname)-5s - %(message)s"
+
+
+def setup_logging(filename: Path) -> None:
+    root_logger = logging.getLogger()
+    # Like basicConfig, only the first call configures logging
+    if root_logger.handlers:
+        return
+    # The file handler runs on the listener thread, so writes don't block the loop
+    file_handler = logging.FileHandler(filename)
+    file_handler.setFormatter(logging.Formatter(LOG_FORMAT))
+    log_queue = SimpleQueue()
+    listener = QueueListener(log_queue, file_handler)
+    root_logger.setLevel(logging.INFO)
+    root_logger.addHandler(QueueHandler(log_queue))
+    listener.start()
+    atexit.register(listener.stop)
@@ -0,0 +1,84 @@
+import asyncio
+import logging
+from asyncio import Queue, QueueShutDown
+from typing import Awaitable, Callable
+
+import aiohttp
+import orjson
+from exceptions import Notion_Rate_Limited_Error
+from settings import settings
+
+logger = logging.getLogger(__name__)
+
+NOTION_BATCH_SIZE = 16
+# Notion allows about 3 requests per second, 429s are retried after Retry-After
+NOTION_CONCURRENCY = 3
+NOTION_ATTEMPTS = 5
+NOTION_RETRY_AFTER = 1
+NOTION_PAGES_URL = f"{settings.notion_api_url}/pages"
+# Page properties that are the same for every apply in a run, serialized once
+NOTION_STATIC_PROPS = {
+    name: orjson.Fragment(orjson.dumps(value))
+    for name, value in {
+        "APPLICATION DATE": {"date": {"start": settings.notion_apply_date}},
+        "STATUS": {"status": {"name": "Applied"}},
+        "RESUME USED": {"relation": [{"id": settings.notion_resume_id}]},
+    }.items()
+}
+NOTION_PARENT = orjson.Fragment(orjson.dumps({"database_id": settings.notion_db_id}))
+
+
+def check_rate_limit(response: aiohttp.ClientResponse) -> None:
+    if response.status == 429:
+        raise Notion_Rate_Limited_Error(
+            float(response.headers.get("Retry-After", NOTION_RETRY_AFTER))
+        )
+
+
+async def add_page_with_retries(
+    semaphore: asyncio.Semaphore,
+    add_page: Callable[..., Awaitable[None]],
+    **kwargs,
+) -> None:
+    for attempt in range(1, NOTION_ATTEMPTS + 1):
+        # The wait holds the slot, so the other writes back off too
+        async with semaphore:
+            try:
+                return await add_page(**kwargs)
+            except Notion_Rate_Limited_Error as e:
+                if attempt == NOTION_ATTEMPTS:
+                    raise
+                await asyncio.sleep(e.retry_after)
+
+
+async def notion_writer(
+    session: aiohttp.ClientSession,
+    notion_queue: Queue,
+    add_page: Callable[..., Awaitable[None]],
+    label_key: str,
+) -> None:
+    # Queued items are add_page kwargs, label_key names the one to log on errors
+    semaphore = asyncio.Semaphore(NOTION_CONCURRENCY)
+    while True:
+        try:
+            applies = [await notion_queue.get()]
+        except QueueShutDown:
+            return
+        while not notion_queue.empty() and len(applies) < NOTION_BATCH_SIZE:
+            applies.append(notion_queue.get_nowait())
+        results = await asyncio.gather(
+            *(
+                add_page_with_retries(
+                    semaphore=semaphore, add_page=add_page, session=session, **apply
+                )
+                for apply in applies
+            ),
+            return_exceptions=True,
+        )
+        for apply, result in zip(applies, results):
+            if isinstance(result, Exception):
+                logger.error(
+                    "%s NOTION: Could not create a page: %r",
+                    apply[label_key],
+                    result,
+                )
@@ -1,20 +1,18 @@
 import argparse
 import asyncio
 import logging
-from asyncio import Queue, create_task
 from enum import Enum
 from pathlib import Path
 
 import aiohttp
+import uvloop
+from client import make_notion_session, make_session, read_error, read_json
+from log_config import setup_logging
 from settings import settings
 
 current_file = Path(__file__)
-logging.basicConfig(
-    level=logging.INFO,
-    format="%(asctime)s - %(levelname)-5s - %(message)s",
-    filename=Path(
-        current_file.parent, "logs", current_file.name.replace(".py", ".log")
-    ),
+setup_logging(
+    Path(current_file.parent, "logs", current_file.name.replace(".py", ".log"))
 )
 logger = logging.getLogger(__name__)
 
@@ -39,107 +37,133 @@ def parse_args() -> int:
     return args.workers
 
 
-async def fill_queue(session: aiohttp.ClientSession, queue: Queue) -> None:
+async def schedule_status_checks(
+    session: aiohttp.ClientSession,
+    notion_session: aiohttp.ClientSession,
+    task_group: asyncio.TaskGroup,
+    semaphore: asyncio.Semaphore,
+) -> None:
     db_filter = {
         "filter": {
             "and": [
                 {"property": "STATUS", "status": {"equals": "Applied"}},
                 {"property": "HH negotiation url", "url": {"is_not_empty": True}},
             ]
-        }
+        },
+        "page_size": 100,
     }
 
     while True:
-        response = await session.post(
+        async with notion_session.post(
             url=f"{settings.notion_api_url}/databases/{settings.notion_db_id}/query",
-            headers=settings.notion_headers,
             json=db_filter,
             proxy=settings.notion_proxy,
-        )
-        if response.status != 200:
-            logger.error(
-                f"Couldn't query database: {response.status} {await response.text()}"
-            )
-            break
-        else:
-            response_json = await response.json()
-            results = response_json["results"]
-            logger.info(f"Received batch {len(results)} results")
-
-            for page in results:
-                page_id, hh_url = (
-                    page["id"],
-                    page["properties"]["HH negotiation url"]["url"],
+        ) as response:
+            if response.status != 200:
+                logger.error(
+                    "Couldn't query database: %s %s",
+                    response.status,
+                    await read_error(response),
                 )
-                logger.info(f"Add page {page_id} with HH url {hh_url} to queue")
-                await queue.put((page_id, hh_url))
-            if response_json.get("has_more") and response_json.get("next_cursor"):
-                db_filter["start_cursor"] = response_json["next_cursor"]
-            else:
                 break
+            else:
+                response_json = await read_json(response)
+                results = response_json["results"]
+                logger.info("Received batch %s results", len(results))
+
+                for page in results:
+                    page_id, hh_url = (
+                        page["id"],
+                        page["properties"]["HH negotiation url"]["url"],
+                    )
+                    logger.info("Add page %s with HH url %s", page_id, hh_url)
+                    task_group.create_task(
+                        process_application_status(
+                            session=session,
+                            notion_session=notion_session,
+                            semaphore=semaphore,
+                            page_id=page_id,
+                            hh_url=hh_url,
+                        )
+                    )
+                if response_json.get("has_more") and response_json.get("next_cursor"):
+                    db_filter["start_cursor"] = response_json["next_cursor"]
+                else:
+                    break
 
 
 async def process_application_status(
-    session: aiohttp.ClientSession, queue: Queue
+    session: aiohttp.ClientSession,
+    notion_session: aiohttp.ClientSession,
+    semaphore: asyncio.Semaphore,
+    page_id: str,
+    hh_url: str,
 ) -> None:
-    while True:
-        page_id, hh_url = await queue.get()
+    async with semaphore:
         try:
             application_status = await get_application_status(
                 session=session, hh_url=hh_url
             )
             if application_status:
                 await update_notion_status(
-                    session=session, page_id=page_id, status=application_status
+                    session=notion_session, page_id=page_id, status=application_status
                 )
             else:
                 logger.info(
-                    f"Processing page {page_id} with HH url {hh_url} from queue: application is not rejected"
+                    "Processing page %s with HH url %s: application is not rejected",
+                    page_id,
+                    hh_url,
                 )
         except Exception as e:
             logger.error(
-                f"Processing page {page_id} with HH url {hh_url} from queue finished with error {str(e)}"
+                "Processing page %s with HH url %s finished with error %s",
+                page_id,
+                hh_url,
+                e,
             )
-        finally:
-            queue.task_done()
 
 
 async def get_application_status(
     session: aiohttp.ClientSession, hh_url: str
 ) -> RejectionType:
-    response = await session.get(
-        url=f"{settings.hh_api_url}/{hh_url.strip('/')}", headers=settings.hh_headers
-    )
-    if response.status != 200:
-        logger.error(
-            f"Couldn't fetch HH url {hh_url}: {response.status} {await response.text()}"
-        )
-        return None
-    else:
-        response_json = await response.json()
-        if response_json["state"]["id"] == "discard":
-            return RejectionType.UNSUCCESSFUL
-        elif response_json["vacancy"]["archived"]:
-            return RejectionType.NO_RESPONSE
-        else:
+    async with session.get(
+        url=f"{settings.hh_api_url}/{hh_url.strip('/')}"
+    ) as response:
+        if response.status != 200:
+            logger.error(
+                "Couldn't fetch HH url %s: %s %s",
+                hh_url,
+                response.status,
+                await read_error(response),
+            )
             return None
+        else:
+            response_json = await read_json(response)
+            if response_json["state"]["id"] == "discard":
+                return RejectionType.UNSUCCESSFUL
+            elif response_json["vacancy"]["archived"]:
+                return RejectionType.NO_RESPONSE
+            else:
+                return None
 
 
 async def update_notion_status(
     session: aiohttp.ClientSession, page_id: str, status: RejectionType
 ) -> None:
-    response = await session.patch(
+    async with session.patch(
         url=f"{settings.notion_api_url}/pages/{page_id}",
-        headers=settings.notion_headers,
         json={"properties": {"STATUS": {"status": {"name": status.value}}}},
         proxy=settings.notion_proxy,
-    )
-    if response.status != 200:
-        logger.error(
-            f"Couldn't update page {page_id}: {response.status} {await response.text()}"
-        )
-    else:
-        logger.info(f"Updated page {page_id}: status set to {status.value}")
+    ) as response:
+        if response.status != 200:
+            logger.error(
+                "Couldn't update page %s: %s %s",
+                page_id,
+                response.status,
+                await read_error(response),
+            )
+        else:
+            logger.info("Updated page %s: status set to %s", page_id, status.value)
 
 
 async def main(workers_num: int) -> None:
@@ -147,19 +171,21 @@ async def main(workers_num: int) -> None:
         logger.error("Notion credentials are not provided, exiting")
         return
 
-    queue = Queue()
-    async with aiohttp.ClientSession() as session:
-        await fill_queue(session=session, queue=queue)
-        workers = [
-            create_task(process_application_status(session=session, queue=queue))
-            for _ in range(workers_num)
-        ]
-        await queue.join()
-        for task in workers:
-            task.cancel()
-        await asyncio.gather(*workers, return_exceptions=True)
+    semaphore = asyncio.Semaphore(workers_num)
+    async with (
+        make_session(workers_num) as session,
+        make_notion_session(workers_num) as notion_session,
+        # Checks start on the first batch while the next ones are queried
+        asyncio.TaskGroup() as task_group,
+    ):
+        await schedule_status_checks(
+            session=session,
+            notion_session=notion_session,
+            task_group=task_group,
+            semaphore=semaphore,
+        )
 
 
 if __name__ == "__main__":
     workers_num = parse_args()
-    asyncio.run(main(workers_num=workers_num))
+    uvloop.run(main(workers_num=workers_num))
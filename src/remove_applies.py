@@ -1,19 +1,18 @@
 import argparse
 import asyncio
 import logging
-from asyncio import Queue, create_task
+from asyncio import Queue, QueueShutDown
 from pathlib import Path
 
 import aiohttp
+import uvloop
+from client import make_notion_session, make_session, read_error, read_json
+from log_config import setup_logging
 from settings import settings
 
 current_file = Path(__file__)
-logging.basicConfig(
-    level=logging.INFO,
-    format="%(asctime)s - %(levelname)-5s - %(message)s",
-    filename=Path(
-        current_file.parent, "logs", current_file.name.replace(".py", ".log")
-    ),
+setup_logging(
+    Path(current_file.parent, "logs", current_file.name.replace(".py", ".log"))
 )
 logger = logging.getLogger(__name__)
 
@@ -40,76 +39,96 @@ async def fill_queue(session: aiohttp.ClientSession, queue: Queue) -> None:
                 {"property": "STATUS", "status": {"equals": "Wrong"}},
                 {"property": "HH negotiation url", "url": {"is_not_empty": True}},
             ]
-        }
+        },
+        "page_size": 100,
     }
 
-    response = await session.post(
-        url=f"{settings.notion_api_url}/databases/{settings.notion_db_id}/query",
-        headers=settings.notion_headers,
-        json=db_filter,
-        proxy=settings.notion_proxy,
-    )
-    if response.status != 200:
-        logger.error(
-            f"Couldn't query database: {response.status} {await response.text()}"
-        )
-    else:
-        response_json = await response.json()
-        results = response_json["results"]
-        logger.info(f"Received {len(results)} results")
-
-        for page in results:
-            page_id, hh_url = (
-                page["id"],
-                page["properties"]["HH negotiation url"]["url"],
-            )
-            logger.info(f"Add page {page_id} with HH url {hh_url} to queue")
-            await queue.put((page_id, hh_url))
-
-
-async def remove_application(session: aiohttp.ClientSession, queue: Queue) -> None:
     while True:
-        page_id, hh_url = await queue.get()
+        async with session.post(
+            url=f"{settings.notion_api_url}/databases/{settings.notion_db_id}/query",
+            json=db_filter,
+            proxy=settings.notion_proxy,
+        ) as response:
+            if response.status != 200:
+                logger.error(
+                    "Couldn't query database: %s %s",
+                    response.status,
+                    await read_error(response),
+                )
+                break
+            else:
+                response_json = await read_json(response)
+                results = response_json["results"]
+                logger.info("Received batch %s results", len(results))
+
+                for page in results:
+                    page_id, hh_url = (
+                        page["id"],
+                        page["properties"]["HH negotiation url"]["url"],
+                    )
+                    logger.info("Add page %s with HH url %s to queue", page_id, hh_url)
+                    queue.put_nowait((page_id, hh_url))
+                if response_json.get("has_more") and response_json.get("next_cursor"):
+                    db_filter["start_cursor"] = response_json["next_cursor"]
+                else:
+                    break
+
+
+async def remove_application(
+    session: aiohttp.ClientSession, notion_session: aiohttp.ClientSession, queue: Queue
+) -> None:
+    while True:
+        try:
+            page_id, hh_url = await queue.get()
+        except QueueShutDown:
+            return
         try:
             if await application_removed(session=session, hh_url=hh_url):
-                await remove_application_from_notion(session=session, page_id=page_id)
+                await remove_application_from_notion(
+                    session=notion_session, page_id=page_id
+                )
         except Exception as e:
             logger.error(
-                f"Processing page {page_id} with HH url {hh_url} from queue finished with error {str(e)}"
+                "Processing page %s with HH url %s from queue finished with error %s",
+                page_id,
+                hh_url,
+                e,
             )
-        finally:
-            queue.task_done()
 
 
 async def application_removed(session: aiohttp.ClientSession, hh_url: str) -> bool:
     hh_url_delete = hh_url.strip("/").replace("negotiations", "negotiations/active")
-    response = await session.delete(
+    async with session.delete(
         url=f"{settings.hh_api_url}/{hh_url_delete}",
-        headers=settings.hh_headers,
-    )
-    if response.status != 204:
-        logger.error(
-            f"Couldn't fetch HH url {hh_url_delete}: {response.status} {await response.text()}"
-        )
-        return False
-    return True
+    ) as response:
+        if response.status != 204:
+            logger.error(
+                "Couldn't fetch HH url %s: %s %s",
+                hh_url_delete,
+                response.status,
+                await read_error(response),
+            )
+            return False
+        return True
 
 
 async def remove_application_from_notion(
     session: aiohttp.ClientSession, page_id: str
 ) -> None:
-    response = await session.patch(
+    async with session.patch(
         url=f"{settings.notion_api_url}/pages/{page_id}",
-        headers=settings.notion_headers,
         json={"archived": True},
         proxy=settings.notion_proxy,
-    )
-    if response.status != 200:
-        logger.error(
-            f"Couldn't remove page {page_id}: {response.status} {await response.text()}"
-        )
-    else:
-        logger.info(f"Removed page {page_id}")
+    ) as response:
+        if response.status != 200:
+            logger.error(
+                "Couldn't remove page %s: %s %s",
+                page_id,
+                response.status,
+                await read_error(response),
+            )
+        else:
+            logger.info("Removed page %s", page_id)
 
 
 async def main(workers_num: int) -> None:
@@ -118,18 +137,22 @@ async def main(workers_num: int) -> None:
         return
 
     queue = Queue()
-    async with aiohttp.ClientSession() as session:
-        await fill_queue(session=session, queue=queue)
-        workers = [
-            create_task(remove_application(session=session, queue=queue))
-            for _ in range(workers_num)
-        ]
-        await queue.join()
-        for task in workers:
-            task.cancel()
-        await asyncio.gather(*workers, return_exceptions=True)
+    async with (
+        make_session(workers_num) as session,
+        make_notion_session(workers_num) as notion_session,
+        asyncio.TaskGroup() as tg,
+    ):
+        for _ in range(workers_num):
+            tg.create_task(
+                remove_application(
+                    session=session, notion_session=notion_session, queue=queue
+                )
+            )
+        await fill_queue(session=notion_session, queue=queue)
+        # Workers exit once the remaining pages are processed
+        queue.shutdown()
 
 
 if __name__ == "__main__":
     workers_num = parse_args()
-    asyncio.run(main(workers_num=workers_num))
+    uvloop.run(main(workers_num=workers_num))
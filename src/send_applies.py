@@ -1,25 +1,50 @@
 import argparse
 import asyncio
 import logging
-from asyncio import Queue, create_task
+import sqlite3
+from asyncio import Queue, QueueShutDown
+from contextlib import closing
 from enum import Enum
+from functools import partial
 from pathlib import Path
-from typing import List, Optional
+from typing import Iterable, List, Optional, Set
 
 import aiohttp
-from exceptions import HH_Limit_Exceeded_Error
-from settings import settings
+import uvloop
+from client import (
+    AdaptiveLimiter,
+    json_payload,
+    make_notion_session,
+    make_session,
+    read_error,
+    read_json,
+)
+from exceptions import HH_Limit_Exceeded_Error, HH_Rate_Limited_Error
+from log_config import setup_logging
+from notion import (
+    NOTION_PAGES_URL,
+    NOTION_PARENT,
+    NOTION_STATIC_PROPS,
+    check_rate_limit,
+    notion_writer,
+)
+from settings import BLACKLIST_REGEX, settings
 
 current_file = Path(__file__)
-logging.basicConfig(
-    level=logging.INFO,
-    format="%(asctime)s - %(levelname)-5s - %(message)s",
-    filename=Path(
-        current_file.parent, "logs", current_file.name.replace(".py", ".log")
-    ),
+setup_logging(
+    Path(current_file.parent, "logs", current_file.name.replace(".py", ".log"))
 )
 logger = logging.getLogger(__name__)
 
+# 429s are retried under the limiter after 1s, 2s, 4s, ...
+APPLY_ATTEMPTS = 5
+RATE_LIMIT_BACKOFF = 1
+# HH maximum, the default of 20 means 5x more page requests
+VACANCIES_PER_PAGE = 100
+APPLIED_DB = Path("data/applied.db")
+VACANCY_LOG_PREFIX = "Page=%02d idx=%02d: %s %s %s"
+VACANCY_SKIP_LOG = f"{VACANCY_LOG_PREFIX} %s"
+
 
 class SearchType(Enum):
     SIMILAR = "similar"
@@ -59,12 +84,10 @@ async def get_vacancies_response(
     session: aiohttp.ClientSession, search: SearchType, page: int = 0
 ) -> Optional[dict]:
     if search == SearchType.SIMILAR:
-        response = await session.get(
-            url=settings.vacancies_url,
-            params={"page": page},
-            headers=settings.hh_headers,
-        )
+        url = settings.vacancies_url
+        params = {"page": page, "per_page": VACANCIES_PER_PAGE}
     elif search == SearchType.QUERY:
+        url = f"{settings.hh_api_url}/vacancies"
         # TODO: use .yml file for this
         params = [
             ("text", "python"),
@@ -76,128 +99,207 @@ async def get_vacancies_response(
             ),
             ("work_format", "REMOTE"),
             ("page", page),
+            ("per_page", VACANCIES_PER_PAGE),
         ]
-        response = await session.get(
-            url=f"{settings.hh_api_url}/vacancies",
-            params=params,
-            headers=settings.hh_headers,
-        )
     else:
         return None
-    if response.status != 200:
-        logger.error(
-            f"Error fetching page {page} with {response.url}: {response.status}\n{await response.text()}"
-        )
-        return None
-    else:
-        response_json = await response.json()
-        return response_json
-
-
-async def fill_queue(queue: Queue, start_page: int, end_page: int) -> None:
-    for i in range(start_page, end_page):
-        logger.info(f"Add page {i} to queue")
-        await queue.put(i)
+    async with session.get(url=url, params=params) as response:
+        if response.status != 200:
+            logger.error(
+                "Error fetching page %s with %s: %s\n%s",
+                page,
+                response.url,
+                response.status,
+                await read_error(response),
+            )
+            return None
+        else:
+            response_json = await read_json(response)
+            return response_json
 
 
-async def fetch_vacancy_page(
-    session: aiohttp.ClientSession, queue: Queue, test_run: bool, search: SearchType
-) -> None:
-    while True:
-        page = await queue.get()
-        response_json = await get_vacancies_response(
-            session=session, page=page, search=search
-        )
-        vacancies = await process_vacancies_response(
-            response_json=response_json, queue=queue, page=page
-        )
+async def page_fetcher(
+    session: aiohttp.ClientSession,
+    semaphore: asyncio.Semaphore,
+    page: int,
+    item_queue: Queue,
+    applied_ids: Set[str],
+    test_run: bool,
+    search: SearchType,
+    limit_reached: asyncio.Event,
+) -> int:
+    try:
+        async with semaphore:
+            if limit_reached.is_set():
+                return 0
+            response_json = await get_vacancies_response(
+                session=session, page=page, search=search
+            )
+        # The item queue is shut down once the limit is reached
+        if limit_reached.is_set():
+            return 0
+        vacancies = process_vacancies_response(response_json=response_json, page=page)
         for idx, vacancy in enumerate(vacancies):
-            logger_basic_message = f"Page={page:02d} idx={idx:02d}: {vacancy['id']} {vacancy['name']} {vacancy['employer']['name']}"
-            if await vacancy_blacklisted_by_words(
+            log_args = (
+                page,
+                idx,
+                vacancy["id"],
+                vacancy["name"],
+                vacancy["employer"]["name"],
+            )
+            if vacancy["id"] in applied_ids:
+                skip_reason = "SKIPPED as already applied"
+            elif "got_response" in vacancy.get("relations", ()):
+                skip_reason = "SKIPPED as already applied on HH"
+            elif vacancy_blacklisted_by_words(
                 " ".join((vacancy["name"], vacancy["employer"]["name"]))
             ):
-                logger.info(f"{logger_basic_message} SKIPPED due to blacklist words")
-                continue
-            elif await vacancy_blacklisted_by_ids(vacancy["id"]):
-                logger.info(f"{logger_basic_message} SKIPPED due to blacklist ID")
-                continue
-            if test_run:
-                logger.info(f"{logger_basic_message} TEST RUN")
+                skip_reason = "SKIPPED due to blacklist words"
+            elif vacancy_blacklisted_by_ids(vacancy["id"]):
+                skip_reason = "SKIPPED due to blacklist ID"
+            elif test_run:
+                skip_reason = "TEST RUN"
+            else:
+                # Applier and Notion logs need the prefix, so only these build it
+                item_queue.put_nowait((vacancy, VACANCY_LOG_PREFIX % log_args))
                 continue
+            logger.info(VACANCY_SKIP_LOG, *log_args, skip_reason)
+        return response_json["pages"] if response_json else 0
+    except Exception as e:
+        logger.error("Fetching page %s finished with error %s", page, e)
+        return 0
+
+
+async def applier(
+    session: aiohttp.ClientSession,
+    item_queue: Queue,
+    notion_queue: Queue,
+    limiter: AdaptiveLimiter,
+    limit_reached: asyncio.Event,
+) -> None:
+    while True:
+        try:
+            vacancy, logger_msg = await item_queue.get()
+        except QueueShutDown:
+            return
+        try:
+            negotiation_url = await apply_under_limiter(
+                session=session,
+                limiter=limiter,
+                limit_reached=limit_reached,
+                vacancy_id=vacancy["id"],
+                logger_msg=logger_msg,
+            )
+            if negotiation_url:
+                notion_queue.put_nowait(
+                    {
+                        "company": vacancy["employer"]["name"],
+                        "position": vacancy["name"],
+                        "url": vacancy["alternate_url"],
+                        "negotiation_url": negotiation_url,
+                        "logger_msg": logger_msg,
+                    }
+                )
+                # Saved right away so a crash later in the run can't lose it
+                await asyncio.to_thread(save_applied_ids, (vacancy["id"],))
+        except HH_Limit_Exceeded_Error:
+            limit_reached.set()
+            item_queue.shutdown(immediate=True)
+        except Exception as e:
+            logger.error("%s apply finished with error %s", logger_msg, e)
 
+
+async def apply_under_limiter(
+    session: aiohttp.ClientSession,
+    limiter: AdaptiveLimiter,
+    limit_reached: asyncio.Event,
+    vacancy_id: str,
+    logger_msg: str,
+) -> Optional[str]:
+    for attempt in range(APPLY_ATTEMPTS):
+        if attempt:
+            await asyncio.sleep(RATE_LIMIT_BACKOFF * 2 ** (attempt - 1))
+        async with limiter as generation:
+            # Other appliers may have hit the limit while this one waited
+            if limit_reached.is_set():
+                return None
             try:
                 negotiation_url = await apply_to_vacancy(
-                    session=session,
-                    vacancy_id=vacancy["id"],
-                    logger_msg=logger_basic_message,
-                )
-            except HH_Limit_Exceeded_Error:
-                queue.shutdown(immediate=True)
-                break
-            if negotiation_url:
-                await add_apply_to_notion(
-                    session=session,
-                    company=vacancy["employer"]["name"],
-                    position=vacancy["name"],
-                    url=vacancy["alternate_url"],
-                    negotiation_url=negotiation_url,
-                    logger_msg=logger_basic_message,
+                    session=session, vacancy_id=vacancy_id, logger_msg=logger_msg
                 )
-        queue.task_done()
+            except HH_Rate_Limited_Error:
+                limiter.throttled(generation)
+                continue
+            # Any answer other than 429 means HH isn't throttling, even a failed apply
+            limiter.succeeded(generation)
+            return negotiation_url
+    logger.error(
+        "%s apply FAILED: still rate limited after %s attempts",
+        logger_msg,
+        APPLY_ATTEMPTS,
+    )
+    return None
 
 
-async def process_vacancies_response(
-    response_json: Optional[dict], queue: Queue, page: int = 0
-) -> List:
+def process_vacancies_response(response_json: Optional[dict], page: int = 0) -> List:
     if response_json:
         if page == 0:
             logger.info(
-                f"Got {response_json['found']} vacancies, {response_json['pages']} pages"
+                "Got %s vacancies, %s pages",
+                response_json["found"],
+                response_json["pages"],
             )
-            await fill_queue(
-                queue=queue, start_page=page + 1, end_page=response_json["pages"]
-            )
-        logger.info(f"Page={page} got {len(response_json['items'])} vacancies")
+        logger.info("Page=%s got %s vacancies", page, len(response_json["items"]))
         return response_json["items"]
     return []
 
 
 async def apply_to_vacancy(
-    session: aiohttp.ClientSession, vacancy_id: int, logger_msg: str
+    session: aiohttp.ClientSession, vacancy_id: str, logger_msg: str
 ) -> Optional[str]:
-    response = await session.post(
+    async with session.post(
         url=settings.negotiation_url,
-        headers=settings.hh_headers,
         data={
             "vacancy_id": vacancy_id,
             "resume_id": settings.resume_id,
             "message": settings.cover_letter,
         },
         allow_redirects=False,
-    )
-    if response.status == 201:
-        logger.info(
-            f"{logger_msg} APPLIED successfully, GOT negotiation url: {response.headers.get('Location', '')}"
-        )
-        return response.headers.get("Location", "")
-    else:
-        error_msg = ""
-        if response.status == 403 or response.status == 400:
-            response_json = await response.json()
-            if any(
-                error["value"] == "limit_exceeded" for error in response_json["errors"]
-            ):
-                logger.error(f"{logger_msg} LIMIT EXCEEDED. Stopping...")
-                raise HH_Limit_Exceeded_Error
-            else:
-                error_msg = response_json["description"]
-        elif response.status == 303:
-            error_msg = (
-                f"External apply required on {response.headers.get('Location', '')}"
+    ) as response:
+        if response.status == 201:
+            logger.info(
+                "%s APPLIED successfully, GOT negotiation url: %s",
+                logger_msg,
+                response.headers.get("Location", ""),
             )
+            return response.headers.get("Location", "")
         else:
-            error_msg = f"Unknown error: {response.status} {await response.text()}"
-        logger.error(f"{logger_msg} apply FAILED with error: {error_msg}")
+            error_msg = ""
+            if response.status == 403 or response.status == 400:
+                response_json = await read_json(response)
+                error_values = {error["value"] for error in response_json["errors"]}
+                if "limit_exceeded" in error_values:
+                    logger.error("%s LIMIT EXCEEDED. Stopping...", logger_msg)
+                    raise HH_Limit_Exceeded_Error
+                elif "already_applied" in error_values:
+                    # Applied before the db existed or by hand, don't POST it again
+                    logger.info("%s SKIPPED as already applied on HH", logger_msg)
+                    await asyncio.to_thread(save_applied_ids, (vacancy_id,))
+                    return None
+                else:
+                    error_msg = response_json["description"]
+            elif response.status == 429:
+                logger.warning("%s RATE LIMITED, will retry", logger_msg)
+                raise HH_Rate_Limited_Error
+            elif response.status == 303:
+                error_msg = (
+                    f"External apply required on {response.headers.get('Location', '')}"
+                )
+            else:
+                error_msg = (
+                    f"Unknown error: {response.status} {await read_error(response)}"
+                )
+            logger.error("%s apply FAILED with error: %s", logger_msg, error_msg)
 
 
 async def add_apply_to_notion(
@@ -212,65 +314,113 @@ async def add_apply_to_notion(
         return
 
     new_page_props = {
+        **NOTION_STATIC_PROPS,
         "COMPANY": {"title": [{"text": {"content": company}}]},
         "POSITION": {"rich_text": [{"type": "text", "text": {"content": position}}]},
-        "APPLICATION DATE": {"date": {"start": settings.notion_apply_date}},
         "JOB POST": {"url": url},
-        "STATUS": {"status": {"name": "Applied"}},
         "HH negotiation url": {"url": negotiation_url},
-        "RESUME USED": {"relation": [{"id": settings.notion_resume_id}]},
     }
-    response = await session.post(
-        url=f"{settings.notion_api_url}/pages",
-        headers=settings.notion_headers,
-        json={
-            "parent": {"database_id": settings.notion_db_id},
-            "properties": new_page_props,
-        },
+    async with session.post(
+        url=NOTION_PAGES_URL,
+        data=json_payload({"parent": NOTION_PARENT, "properties": new_page_props}),
         proxy=settings.notion_proxy,
-    )
-    if response.status != 200:
-        logger.error(
-            f"{logger_msg} NOTION: Could not create a page: {response.status} {await response.text()}"
-        )
-    else:
-        response_json = await response.json()
-        logger.info(f"{logger_msg} NOTION: Page created with id: {response_json['id']}")
+    ) as response:
+        check_rate_limit(response)
+        if response.status != 200:
+            logger.error(
+                "%s NOTION: Could not create a page: %s %s",
+                logger_msg,
+                response.status,
+                await read_error(response),
+            )
+        else:
+            response_json = await read_json(response)
+            logger.info(
+                "%s NOTION: Page created with id: %s", logger_msg, response_json["id"]
+            )
 
 
-async def vacancy_blacklisted_by_words(vacancy_text: str) -> bool:
-    return any(
-        word in settings.blacklist_words
-        for word in settings.blacklist_regex.findall(vacancy_text.lower())
+def vacancy_blacklisted_by_words(vacancy_text: str) -> bool:
+    return not settings.blacklist_words.isdisjoint(
+        BLACKLIST_REGEX.findall(vacancy_text.lower())
     )
 
 
-async def vacancy_blacklisted_by_ids(vacancy_id: str) -> bool:
+def vacancy_blacklisted_by_ids(vacancy_id: str) -> bool:
     return vacancy_id in settings.blacklist_ids
 
 
+def load_applied_ids() -> Set[str]:
+    APPLIED_DB.parent.mkdir(exist_ok=True)
+    with closing(sqlite3.connect(APPLIED_DB)) as db:
+        db.execute("CREATE TABLE IF NOT EXISTS applied (id TEXT PRIMARY KEY)")
+        return {row[0] for row in db.execute("SELECT id FROM applied")}
+
+
+def save_applied_ids(vacancy_ids: Iterable[str]) -> None:
+    with closing(sqlite3.connect(APPLIED_DB)) as db, db:
+        db.executemany(
+            "INSERT OR IGNORE INTO applied (id) VALUES (?)",
+            ((vacancy_id,) for vacancy_id in vacancy_ids),
+        )
+
+
 async def main(workers_num: int, test_run: bool, search: SearchType) -> None:
     if not settings.notion_enabled:
         logger.info("NOTION: Notion is disabled")
 
-    queue = Queue()
-    async with aiohttp.ClientSession() as session:
-        await queue.put(0)
-        workers = [
-            create_task(
-                fetch_vacancy_page(
-                    session=session, queue=queue, test_run=test_run, search=search
+    item_queue = Queue()
+    notion_queue = Queue()
+    applied_ids = await asyncio.to_thread(load_applied_ids)
+    logger.info("Loaded %s already applied vacancies", len(applied_ids))
+    # Applies start one at a time and ramp up to workers_num while HH doesn't 429
+    limiter = AdaptiveLimiter(max_limit=workers_num)
+    limit_reached = asyncio.Event()
+    async with (
+        make_session(workers_num) as session,
+        make_notion_session(workers_num) as notion_session,
+    ):
+        fetch_page = partial(
+            page_fetcher,
+            session=session,
+            semaphore=asyncio.Semaphore(workers_num),
+            item_queue=item_queue,
+            applied_ids=applied_ids,
+            test_run=test_run,
+            search=search,
+            limit_reached=limit_reached,
+        )
+        async with asyncio.TaskGroup() as writer_tg:
+            writer_tg.create_task(
+                notion_writer(
+                    session=notion_session,
+                    notion_queue=notion_queue,
+                    add_page=add_apply_to_notion,
+                    label_key="logger_msg",
                 )
             )
-            for _ in range(workers_num)
-        ]
-        await queue.join()
-        for task in workers:
-            task.cancel()
-        await asyncio.gather(*workers, return_exceptions=True)
-    logger.info(f"{'-' * 60}Done")
+            async with asyncio.TaskGroup() as applier_tg:
+                for _ in range(workers_num):
+                    applier_tg.create_task(
+                        applier(
+                            session=session,
+                            item_queue=item_queue,
+                            notion_queue=notion_queue,
+                            limiter=limiter,
+                            limit_reached=limit_reached,
+                        )
+                    )
+                # Page count is only known after the first page
+                pages = await fetch_page(page=0)
+                async with asyncio.TaskGroup() as fetcher_tg:
+                    for page in range(1, pages):
+                        fetcher_tg.create_task(fetch_page(page=page))
+                # Appliers exit once the queued vacancies are processed
+                item_queue.shutdown()
+            notion_queue.shutdown()
+    logger.info("%sDone", "-" * 60)
 
 
 if __name__ == "__main__":
     workers_num, test_run, search = parse_args()
-    asyncio.run(main(workers_num=workers_num, test_run=test_run, search=search))
+    uvloop.run(main(workers_num=workers_num, test_run=test_run, search=search))
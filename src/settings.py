@@ -1,78 +1,84 @@
 import re
 from datetime import datetime
+from functools import cached_property
 from pathlib import Path
 from typing import Optional
 
-from pydantic import Field, computed_field
-from pydantic_settings import BaseSettings
+from multidict import CIMultiDict, CIMultiDictProxy
+from pydantic_settings import BaseSettings, SettingsConfigDict
+
+BLACKLIST_REGEX = re.compile(r"\b[0-9а-яa-z]+\b")
 
 
 class Settings(BaseSettings):
-    hh_token: str = Field(..., env="HH_TOKEN")
-    resume_id: str = Field(..., env="RESUME_ID")
-    hh_api_url: str = Field("https://api.hh.ru", env="HH_API_URL")
-    notion_api_url: str = Field("https://api.notion.com/v1", env="NOTION_API_URL")
-    notion_secret: str = Field("", env="NOTION_SECRET")
-    notion_db_id: str = Field("", env="NOTION_DB_ID")
-    notion_proxy: Optional[str] = Field(None, env="NOTION_PROXY")
-    notion_resume_id: str = Field("", env="NOTION_RESUME_ID")
-
-    @computed_field
+    model_config = SettingsConfigDict(env_file=".env", extra="ignore", frozen=True)
+
+    hh_token: str
+    resume_id: str
+    hh_api_url: str = "https://api.hh.ru"
+    notion_api_url: str = "https://api.notion.com/v1"
+    notion_secret: str = ""
+    notion_db_id: str = ""
+    notion_proxy: Optional[str] = None
+    notion_resume_id: str = ""
+
+    @cached_property
     def vacancies_url(self) -> str:
         return (
             f"{self.hh_api_url.rstrip('/')}/resumes/{self.resume_id}/similar_vacancies"
         )
 
-    @computed_field
+    @cached_property
     def negotiation_url(self) -> str:
         return f"{self.hh_api_url.rstrip('/')}/negotiations"
 
-    @computed_field
-    def hh_headers(self) -> dict:
-        return {"Authorization": f"Bearer {self.hh_token}"}
-
-    @computed_field
-    def notion_headers(self) -> dict:
-        return {
-            "Authorization": f"Bearer {self.notion_secret}",
-            "Notion-Version": "2022-06-28",
-        }
+    # Built once and immutable, so sessions can share them without copying
+    @cached_property
+    def hh_headers(self) -> CIMultiDictProxy:
+        return CIMultiDictProxy(CIMultiDict(Authorization=f"Bearer {self.hh_token}"))
+
+    @cached_property
+    def notion_headers(self) -> CIMultiDictProxy:
+        return CIMultiDictProxy(
+            CIMultiDict(
+                {
+                    "Authorization": f"Bearer {self.notion_secret}",
+                    "Notion-Version": "2022-06-28",
+                }
+            )
+        )
 
-    @computed_field
+    # Captured once so a run spanning midnight keeps a single date
+    @cached_property
     def notion_apply_date(self) -> str:
         return datetime.now().strftime("%Y-%m-%d")
 
-    @computed_field
+    @cached_property
     def notion_enabled(self) -> bool:
-        return self.notion_db_id and self.notion_secret
+        return bool(self.notion_db_id and self.notion_secret)
 
-    @computed_field
+    @cached_property
     def cover_letter(self) -> str:
         path = Path("data/cover_letter.txt")
         return path.read_text() if path.exists() else ""
 
-    @computed_field
-    def blacklist_words(self) -> str:
+    @cached_property
+    def blacklist_words(self) -> frozenset[str]:
         path = Path("data/blacklist_words.txt")
-        return (
-            set(map(str.lower, path.read_text().splitlines())) if path.exists() else ""
+        if not path.exists():
+            return frozenset()
+        return frozenset(
+            word.lower()
+            for line in path.read_text().splitlines()
+            if (word := line.strip())
         )
 
-    @computed_field
-    def blacklist_ids(self) -> str:
+    @cached_property
+    def blacklist_ids(self) -> frozenset[str]:
         path = Path("data/blacklist_ids.txt")
-        return (
-            set(map(str.lower, path.read_text().splitlines())) if path.exists() else ""
-        )
-
-    @computed_field
-    def blacklist_regex(self) -> str:
-        return re.compile(r"\b[0-9а-яa-z]+\b")
-
-    class Config:
-        env_file = ".env"
-        extra = "ignore"
-        frozen = True
+        if not path.exists():
+            return frozenset()
+        return frozenset(path.read_text().split())
 
 
 settings = Settings()
@@ -1,5 +1,5 @@
 import argparse
-import aiohttp
+from client import make_notion_session, make_session
 from send_applies import SearchType, add_apply_to_notion, apply_to_vacancy, get_vacancies_response
 
 def parse_args() -> int:
@@ -19,13 +19,13 @@ def parse_args() -> int:
     return args.search
 
 async def send(search):
-    async with aiohttp.ClientSession() as session:
+    async with make_session(1) as session, make_notion_session(1) as notion_session:
         response_json = await get_vacancies_response(session=session, page=0, search=search)
         vacancy = response_json["items"][0]
         negotiation_url = await apply_to_vacancy(session=session, vacancy_id=vacancy["id"], logger_msg="")
         if negotiation_url:
             await add_apply_to_notion(
-                session=session,
+                session=notion_session,
                 company=vacancy["employer"]["name"],
                 position=vacancy["name"],
                 url=vacancy["alternate_url"],
@@ -34,6 +34,6 @@ async def send(search):
             )
 
 if __name__ == "__main__":
-    import asyncio
+    import uvloop
     search = parse_args()
-    asyncio.run(send(search))
\ No newline at end of file
+    uvloop.run(send(search))
\ No newline at end of file